@@ -10,6 +10,8 @@ from typing import Optional, Sequence, Tuple
 from urllib import error, parse, request
 
 import interface
+import peer
+import subscriber
 from interface import MenuOptions
 
 SERVER_PORT = 31683
@@ -31,7 +33,7 @@ def _chat_history(command_in: MenuOptions,
         interface.missing_server_address()
         return
 
-    url = "http://" + server_address + ":" + str(SERVER_PORT) + "/chat-history"
+    url = "http://" + server_address + "/chat-history"
 
     try:
         reply = request.urlopen(url, timeout=TIMEOUT).read()
@@ -62,7 +64,7 @@ def _claim_nickname(command_in: MenuOptions,
 
     nickname = parameters_in[0]
     cookie = None
-    url = "http://" + server_address + ":" + str(SERVER_PORT) + "/claim-nick"
+    url = "http://" + server_address + "/claim-nick"
 
     try:
         contents = parse.urlencode({"nickname": nickname}).encode("ascii")
@@ -92,6 +94,23 @@ def _claim_nickname(command_in: MenuOptions,
     return cookie, nickname
 
 
+def _client_address(server_address: str, nickname: str) -> Optional[str]:
+    _logger.debug("Requesting address of %s", nickname)
+    query = parse.urlencode({"nickname": nickname})
+    url = "http://" + server_address + "/client-address?" + query
+
+    try:
+        reply_msg = request.urlopen(url, timeout=TIMEOUT).read().decode("ascii")
+    except error.URLError as e:
+        _logger.info("Couldn't resolve address of %s: %s", nickname, e)
+        return None
+
+    if not reply_msg.startswith("tcp://"):
+        _logger.info("Unexpected address for %s: %s", nickname, reply_msg)
+        return None
+    return reply_msg
+
+
 def _help(command_in: MenuOptions, parameters_in: Sequence[str]):
     _logger.debug("Handling help")
     command_help = None
@@ -107,9 +126,43 @@ def _help(command_in: MenuOptions, parameters_in: Sequence[str]):
     interface.print_help(command_help)
 
 
+def _join_server(command_in: MenuOptions,
+                 parameters_in: Sequence[str],
+                 server_address: str,
+                 channel: subscriber.ChannelSubscriber):
+    _logger.debug("Joining the chat channel")
+
+    if len(parameters_in) != 0:
+        interface.invalid_parameter_count(command_in, parameters_in)
+        return
+
+    if server_address is None:
+        interface.missing_server_address()
+        return
+
+    url = "http://" + server_address + "/join"
+
+    try:
+        reply_msg = request.urlopen(url, timeout=TIMEOUT).read().decode("ascii")
+        port = int(reply_msg)
+    except (error.URLError, ValueError) as e:
+        _logger.warning("Unhandled exception in joining: %s", e)
+        interface.unexpected_response(str(e))
+        return
+
+    # The publish port is fixed, so the subscription survives server restarts
+    # without asking for the port again
+    channel.subscribe(_server_host(server_address),
+                      port,
+                      interface.print_channel_message,
+                      interface.print_presence,
+                      lambda sequence: _resync(server_address, sequence))
+    interface.channel_joined(channel.endpoint)
+
+
 def _ping_server(server_ip: str) -> bool:
     _logger.debug("Pinging server")
-    url = "http://" + server_ip + ":" + str(SERVER_PORT) + "/ping"
+    url = "http://" + server_ip + "/ping"
     try:
         reply_msg = request.urlopen(url, timeout=TIMEOUT).read().decode("ascii")
     except error.URLError as e:
@@ -126,6 +179,59 @@ def _ping_server(server_ip: str) -> bool:
     return False
 
 
+def _private_message(command_in: MenuOptions,
+                     parameters_in: Sequence[str],
+                     peers: peer.PeerPool,
+                     nickname: str):
+    _logger.debug("Sending private message")
+    if len(parameters_in) < 2:
+        interface.invalid_parameter_count(command_in, parameters_in)
+        return
+
+    if nickname is None:
+        interface.missing_nickname()
+        return
+
+    receiver = parameters_in[0]
+    message = " ".join(parameters_in[1:])
+
+    try:
+        peers.send(nickname, receiver, message)
+    except peer.PeerUnreachableException as e:
+        _logger.info(e)
+        interface.peer_unreachable(receiver)
+        return
+    interface.private_message_sent(receiver)
+
+
+def _register_address(server_address: str, cookie_in: str, port: int):
+    _logger.debug("Registering P2P address")
+    url = "http://" + server_address + "/register-address"
+
+    try:
+        contents = parse.urlencode({"port": port}).encode("ascii")
+        req = request.Request(url, data=contents, headers={"cookie": cookie_in})
+        reply_msg = request.urlopen(req, timeout=TIMEOUT).read().decode("ascii")
+    except error.URLError as e:
+        _logger.warning("Unhandled exception in address registration: %s", e)
+        return
+    _logger.info(reply_msg)
+
+
+def _resync(server_address: str, sequence: int):
+    # The server noticed that this client has missed messages on the channel
+    _logger.info("Resyncing from message %s", sequence)
+    query = parse.urlencode({"since": sequence})
+    url = "http://" + server_address + "/chat-history?" + query
+
+    try:
+        messages = json.loads(request.urlopen(url, timeout=TIMEOUT).read())
+    except (error.URLError, json.decoder.JSONDecodeError) as e:
+        _logger.warning("Unhandled exception in resync: %s", e)
+        return
+    interface.print_missed_messages(messages)
+
+
 def run():
     """Try for modular structure:
     Open interface's main menu
@@ -138,6 +244,10 @@ def run():
     cookie = None
     nickname = None
     server_address = None
+    # Resolving is done lazily so that the currently set server is used
+    peers = peer.PeerPool(lambda peer_nickname: _client_address(server_address,
+                                                                 peer_nickname))
+    channel = subscriber.ChannelSubscriber()
 
     interface.welcome()
 
@@ -166,10 +276,14 @@ def run():
                 # Otherwise the nickname is kept as it was: either
                 # None = unclaimed or the previously claimed nickname.
                 nickname = new_nickname
+                channel.cookie = cookie
+                channel.nickname = nickname
+                # Make this client reachable for private messages
+                port = peers.listen(interface.print_private_message)
+                _register_address(server_address, cookie, port)
 
         elif command_in == MenuOptions.JOIN_SERVER:
-            # _join_server(command_in, parameters_in)
-            pass
+            _join_server(command_in, parameters_in, server_address, channel)
 
         elif command_in == MenuOptions.SEND_MESSAGE:
             _send_message(command_in, parameters_in, server_address, cookie)
@@ -177,6 +291,14 @@ def run():
 
         elif command_in == MenuOptions.HELP:
             _help(command_in, parameters_in)
+
+        elif command_in == MenuOptions.WHO:
+            _who(command_in, parameters_in, server_address)
+
+        elif command_in == MenuOptions.PRIVATE_MESSAGE:
+            _private_message(command_in, parameters_in, peers, nickname)
+    peers.close()
+    channel.close()
     interface.exit_application()
 
 
@@ -199,7 +321,7 @@ def _send_message(command_in: MenuOptions,
 
     message = " ".join(parameters_in)
     cookie = None
-    url = "http://" + server_address + ":" + str(SERVER_PORT) + "/send-message"
+    url = "http://" + server_address + "/send-message"
 
     try:
         contents = parse.urlencode({"message": message}).encode("ascii")
@@ -223,20 +345,63 @@ def _send_message(command_in: MenuOptions,
     return
 
 
+def _server_host(server_address: str) -> str:
+    # The server address is stored as "host:port" for the HTTP requests
+    return server_address.rpartition(":")[0]
+
+
 def _set_server(command_in: MenuOptions, parameters_in: Sequence[str]) -> Optional[str]:
     _logger.debug("Setting server address")
     if len(parameters_in) != 1:
         interface.invalid_parameter_count(command_in, parameters_in)
         return None
-    server_ip = parameters_in[0]
+    server_ip, port = parameters_in[0], str(SERVER_PORT)
+    if server_ip.startswith("["):
+        # IPv6 address with a port, e.g. [::1]:31683
+        server_ip, _, port = server_ip[1:].partition("]:")
+    elif server_ip.count(":") == 1:
+        server_ip, port = server_ip.split(":")
     try:
         ipaddress.ip_address(server_ip)
     except ValueError:
         interface.invalid_ip_address(server_ip)
         return None
-    if _ping_server(server_ip):
-        _logger.info("Set server address to {}".format(server_ip))
-        return server_ip
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        interface.invalid_port(port)
+        return None
+    host = "[" + server_ip + "]" if ":" in server_ip else server_ip
+    server_address = host + ":" + port
+    if _ping_server(server_address):
+        _logger.info("Set server address to {}".format(server_address))
+        return server_address
+
+
+def _who(command_in: MenuOptions,
+         parameters_in: Sequence[str],
+         server_address: str):
+    _logger.debug("Requesting online users")
+
+    if len(parameters_in) != 0:
+        interface.invalid_parameter_count(command_in, parameters_in)
+        return
+
+    if server_address is None:
+        interface.missing_server_address()
+        return
+
+    url = "http://" + server_address + "/who"
+
+    try:
+        reply = request.urlopen(url, timeout=TIMEOUT).read()
+    except error.URLError as e:
+        _logger.warning("Unhandled exception in who: %s", e)
+        reply = e.reason.encode("ascii")
+
+    try:
+        nicknames = json.loads(reply)
+        interface.print_online(nicknames)
+    except json.decoder.JSONDecodeError:
+        interface.unexpected_response(reply.decode("ascii"))
 
 
 if __name__ == "__main__":
@@ -12,7 +12,9 @@ class MenuOptions(enum.Enum):
     CLAIM_NICKNAME = 3
     JOIN_SERVER = 4
     SEND_MESSAGE = 5
-    QUIT = 6
+    PRIVATE_MESSAGE = 6
+    WHO = 7
+    QUIT = 8
 
 
 MENU_COMMANDS = {
@@ -37,6 +39,13 @@ MENU_COMMANDS = {
     "MESSAGE": MenuOptions.SEND_MESSAGE,
     "MSG": MenuOptions.SEND_MESSAGE,
 
+    "PRIVATE-MESSAGE": MenuOptions.PRIVATE_MESSAGE,
+    "PRIVATE": MenuOptions.PRIVATE_MESSAGE,
+    "PM": MenuOptions.PRIVATE_MESSAGE,
+
+    "WHO": MenuOptions.WHO,
+    "ONLINE": MenuOptions.WHO,
+
     "QUIT": MenuOptions.QUIT,
     "Q": MenuOptions.QUIT,
     "EXIT": MenuOptions.QUIT,
@@ -54,9 +63,9 @@ _MENU_COMMAND_INFO = {
     },
     MenuOptions.SERVER: {
         "name": ("SERVER", "aliases: "),
-        "description": "set the server address",
-        "usage": "server <IP ADDRESS>",
-        "example": "server 35.228.135.146",
+        "description": "set the server address, the port defaults to 31683",
+        "usage": "server <IP ADDRESS>[:PORT]",
+        "example": "server 35.228.135.146:31693",
         "parameter-count": (1, ),
     },
     MenuOptions.CHAT_HISTORY: {
@@ -87,6 +96,20 @@ _MENU_COMMAND_INFO = {
         "example": "MSG This message shall be sent.",
         "parameter-count": (1, ),
     },
+    MenuOptions.PRIVATE_MESSAGE: {
+        "name": ("PRIVATE-MESSAGE", "aliases: PRIVATE, PM"),
+        "description": "send a message directly to another user",
+        "usage": "PM <NICKNAME> <MESSAGE>",
+        "example": "PM user1234 This message is only for you.",
+        "parameter-count": (2, ),
+    },
+    MenuOptions.WHO: {
+        "name": ("WHO", "aliases: ONLINE"),
+        "description": "list the users currently in the chatroom",
+        "usage": "WHO",
+        "example": "WHO",
+        "parameter-count": (0, ),
+    },
     MenuOptions.QUIT: {
         "name": ("QUIT", "aliases: Q, EXIT, SHUTDOWN, CLOSE"),
         "description": "close the application",
@@ -100,6 +123,10 @@ _logger = logging.getLogger("INTERFACE")
 _PADDING = 32
 
 
+def channel_joined(endpoint: str):
+    print("Joined the chatroom at {}.".format(endpoint))
+
+
 def exit_application(nickname: str = None):
     if nickname is not None:
         print("Goodbye {}.".format(nickname))
@@ -133,6 +160,10 @@ def invalid_parameter_count(command: MenuOptions, parameters: Sequence[str]):
     print_command_usage(command)
 
 
+def invalid_port(port: str):
+    print("\nInvalid port: {}.".format(port))
+
+
 def invalid_server_address(server_ip: str):
     print("Couldn't connect to {}. Check the address.".format(server_ip))
 
@@ -187,6 +218,10 @@ def _print_available_commands():
             print(i["name"])
 
 
+def peer_unreachable(nickname: str):
+    print("\nCouldn't reach {} directly. They may be offline.".format(nickname))
+
+
 def print_chat_log(messages: Sequence[str]):
     if len(messages) == 0:
         print("\nNo messages in chatlog.\n")
@@ -204,11 +239,41 @@ def print_chat_log(messages: Sequence[str]):
     print("{}".format((2 * _PADDING) * "-"))
 
 
+def print_channel_message(message: str):
+    print("\n{}".format(message))
+
+
 def print_command_usage(command: MenuOptions):
     print("Usage: " + _MENU_COMMAND_INFO[command]["usage"])
     print("For help, run 'HELP {}'".format(_MENU_COMMAND_INFO[command]["name"][0]))
 
 
+def print_missed_messages(messages: Sequence[str]):
+    print("\n{} MISSED MESSAGES {}".format(_PADDING * "-", _PADDING * "-"))
+    for message in messages:
+        print(message)
+    print("{}".format((2 * _PADDING) * "-"))
+
+
+def print_online(nicknames: Sequence[str]):
+    if len(nicknames) == 0:
+        print("\nNo one is online.\n")
+        return
+    print("\nOnline ({}): {}".format(len(nicknames), ", ".join(nicknames)))
+
+
+def print_presence(event: str, nickname: str):
+    if event == "join":
+        print("\n*** {} joined the chatroom".format(nickname))
+    elif event == "leave":
+        print("\n*** {} left the chatroom".format(nickname))
+
+
+def print_private_message(sender: str, message: str):
+    # The sender is given by the sending client itself and isn't verified
+    print("\n[PRIVATE] {} (unverified): {}".format(sender, message))
+
+
 def print_help(command_in: MenuOptions = None):
 
     def print_command_info(cmd: MenuOptions):
@@ -241,6 +306,10 @@ def print_help(command_in: MenuOptions = None):
         print("\n")
 
 
+def private_message_sent(nickname: str):
+    print("Private message sent to {}.".format(nickname))
+
+
 def unexpected_response(reply: str):
     print("The server responded unexpectedly: {}".format(reply))
 
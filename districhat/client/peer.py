@@ -0,0 +1,110 @@
+"""Direct client-to-client messaging. The server is only used for resolving the
+ZMQ endpoint of a nickname, the private messages themselves are sent over a
+direct ZMQ connection to the receiving client. Connections are pooled by
+nickname so that the address lookup is only needed for the first message or
+after the peer has moved to a new address.
+
+The receiving port is open to anyone, and the sender of a private message is
+only what the sending client claims to be, so it is shown as unverified.
+"""
+import logging
+import threading
+
+from typing import Callable, Dict, Optional
+
+import zmq
+
+ZMQ_BIND_ADDRESS = "tcp://0.0.0.0"
+SEND_TIMEOUT = 1000  # milliseconds
+POLL_TIMEOUT = 500  # milliseconds
+
+_logger = logging.getLogger("PEER")
+
+
+class PeerUnreachableException(Exception):
+    pass
+
+
+class PeerPool:
+    def __init__(self, resolve_address: Callable[[str], Optional[str]]):
+        # resolve_address maps a nickname into a ZMQ endpoint, or None if the
+        # server doesn't know of a reachable client with the nickname
+        self._resolve_address = resolve_address
+        self._context = zmq.Context.instance()
+        self._sockets: Dict[str, zmq.Socket] = {}
+        self._receive_socket = None
+        self._stop = threading.Event()
+        self.port = None
+
+    def close(self):
+        for nickname in list(self._sockets.keys()):
+            self.forget(nickname)
+        # The receiving socket is closed by its own thread
+        self._stop.set()
+
+    def forget(self, nickname: str):
+        socket = self._sockets.pop(nickname, None)
+        if socket is not None:
+            socket.close(linger=0)
+
+    def listen(self, on_message: Callable[[str, str], None]) -> int:
+        """Bind the socket the other clients send private messages to and start
+        a daemon thread passing the received messages to on_message.
+        Returns the bound port which is to be registered to the server.
+        """
+        if self._receive_socket is not None:
+            return self.port
+        self._receive_socket = self._context.socket(zmq.PULL)
+        self.port = self._receive_socket.bind_to_random_port(ZMQ_BIND_ADDRESS,
+                                                             min_port=49152,
+                                                             max_port=65536,
+                                                             max_tries=100)
+        _logger.info("Listening for private messages on port %s", self.port)
+        threading.Thread(target=self._receive,
+                         args=(self._receive_socket, on_message),
+                         daemon=True).start()
+        return self.port
+
+    def send(self, sender: str, nickname: str, message: str):
+        for attempt in range(2):
+            socket = self._get_socket(nickname)
+            try:
+                socket.send_json({"sender": sender, "message": message})
+                return
+            except zmq.Again:
+                # The cached endpoint is stale, look the address up again
+                _logger.info("Sending to %s timed out (attempt %s)", nickname, attempt + 1)
+                self.forget(nickname)
+        raise PeerUnreachableException("Couldn't reach {}".format(nickname))
+
+    def _get_socket(self, nickname: str) -> zmq.Socket:
+        if nickname in self._sockets.keys():
+            return self._sockets[nickname]
+        address = self._resolve_address(nickname)
+        if address is None:
+            raise PeerUnreachableException("No address for {}".format(nickname))
+        socket = self._context.socket(zmq.PUSH)
+        # Only queue messages once connected, so that sending to an offline or
+        # moved peer times out instead of being reported as sent
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.setsockopt(zmq.SNDTIMEO, SEND_TIMEOUT)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(address)
+        _logger.debug("Connected to %s at %s", nickname, address)
+        self._sockets[nickname] = socket
+        return socket
+
+    def _receive(self, socket: zmq.Socket, on_message: Callable[[str, str], None]):
+        while not self._stop.is_set():
+            if not socket.poll(POLL_TIMEOUT):
+                continue
+            try:
+                contents = socket.recv_json()
+            except ValueError:
+                contents = None
+            if not isinstance(contents, dict):
+                # Anything can be sent to the port, it mustn't end the thread
+                _logger.warning("Received malformed private message")
+                continue
+            on_message(str(contents.get("sender", "?")), str(contents.get("message", "")))
+        socket.close(linger=0)
@@ -0,0 +1,186 @@
+"""Subscription to the server's chat channel. The server publishes the chat
+messages on a fixed port, so once subscribed ZMQ keeps reconnecting to the same
+endpoint by itself when the server restarts. Joining the channel again through
+the server is not needed.
+
+While subscribed, the client also sends heartbeats to the port right after the
+publish port so that the server knows the client is online. The heartbeats
+carry the sequence number of the last chat message received, the number of
+messages missed and the first missed message not yet recovered, and the server
+tells a client that has missed messages or fallen behind to resync from there.
+The counts start over when the server restarts, which the client notices from
+the sequence numbers starting over.
+"""
+import logging
+import threading
+import time
+
+from typing import Callable
+
+import zmq
+
+CHANNEL_TOPIC = "ALL"
+PRESENCE_TOPIC = "PRESENCE"
+RESYNC_TOPIC = "RESYNC"
+HEARTBEAT = b"HB"
+HEARTBEAT_INTERVAL = 5.0  # seconds
+HEARTBEAT_PORT_OFFSET = 1
+LEAVE = b"BYE"
+POLL_TIMEOUT = 0.5  # seconds
+RECONNECT_INTERVAL = 100  # milliseconds
+RECONNECT_INTERVAL_MAX = 5000  # milliseconds
+STOP_TIMEOUT = 2.0  # seconds
+
+_logger = logging.getLogger("SUBSCRIBER")
+
+
+class ChannelSubscriber:
+    def __init__(self):
+        self._context = zmq.Context.instance()
+        self._stop = None
+        self._thread = None
+        self.endpoint = None
+        # Identifies the client in the heartbeats, set once a nickname is claimed
+        self.cookie = None
+        self.nickname = None
+        self.last_sequence = None
+        self.missed = 0
+        self.first_missed = None
+
+    def close(self):
+        # The sockets are closed by the receiving thread as ZMQ sockets must not
+        # be shared between threads
+        if self._stop is not None:
+            self._stop.set()
+            # Give the thread time to tell the server the client is leaving
+            self._thread.join(STOP_TIMEOUT)
+            self._stop = None
+            self._thread = None
+            self.endpoint = None
+
+    def subscribe(self,
+                  server_address: str,
+                  port: int,
+                  on_message: Callable[[str], None],
+                  on_presence: Callable[[str, str], None],
+                  on_resync: Callable[[int], None]):
+        endpoint = "tcp://{}:{}".format(server_address, port)
+        if self.endpoint == endpoint:
+            return
+        # Changing to another server
+        self.close()
+        self._stop = threading.Event()
+        self.endpoint = endpoint
+        self.last_sequence = None
+        self.missed = 0
+        self.first_missed = None
+        heartbeat_endpoint = "tcp://{}:{}".format(server_address, port + HEARTBEAT_PORT_OFFSET)
+        self._thread = threading.Thread(target=self._receive,
+                                        args=(endpoint,
+                                              heartbeat_endpoint,
+                                              on_message,
+                                              on_presence,
+                                              on_resync,
+                                              self._stop),
+                                        daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self, socket: zmq.Socket, kind: bytes) -> bool:
+        # Returns whether the heartbeat was sent
+        cookie = self.cookie
+        if cookie is None:
+            return False
+        frames = [kind, cookie.encode("ascii")]
+        if self.last_sequence is not None:
+            frames += [str(self.last_sequence).encode("ascii"),
+                       str(self.missed).encode("ascii")]
+            first_missed = self.first_missed
+            if first_missed is not None:
+                frames.append(str(first_missed).encode("ascii"))
+        try:
+            socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            # Not connected to the server at the moment, a stale heartbeat
+            # isn't worth queueing
+            return False
+        return True
+
+    def _resynced(self, sequence: int):
+        # The messages from the sequence number onwards have been fetched
+        if self.first_missed is not None and sequence <= self.first_missed:
+            self.first_missed = None
+
+    @staticmethod
+    def _resync_topic(nickname: str) -> str:
+        # The space keeps e.g. "bob" from matching the notices of "bobby"
+        return "{} {} ".format(RESYNC_TOPIC, nickname)
+
+    def _track_sequence(self, sequence: int):
+        if self.last_sequence is not None and sequence <= self.last_sequence:
+            # The server has restarted and numbers the messages from the start
+            self.missed = 0
+            self.first_missed = None
+        elif self.last_sequence is not None and sequence > self.last_sequence + 1:
+            # Messages were dropped on the way, e.g. past the server's HWM
+            self.missed += sequence - self.last_sequence - 1
+            if self.first_missed is None:
+                self.first_missed = self.last_sequence + 1
+        self.last_sequence = sequence
+
+    def _receive(self,
+                 endpoint: str,
+                 heartbeat_endpoint: str,
+                 on_message: Callable[[str], None],
+                 on_presence: Callable[[str, str], None],
+                 on_resync: Callable[[int], None],
+                 stop: threading.Event):
+        socket = self._context.socket(zmq.SUB)
+        socket.setsockopt(zmq.RECONNECT_IVL, RECONNECT_INTERVAL)
+        socket.setsockopt(zmq.RECONNECT_IVL_MAX, RECONNECT_INTERVAL_MAX)
+        socket.setsockopt_string(zmq.SUBSCRIBE, CHANNEL_TOPIC)
+        socket.setsockopt_string(zmq.SUBSCRIBE, PRESENCE_TOPIC)
+        socket.connect(endpoint)
+        heartbeat_socket = self._context.socket(zmq.PUSH)
+        heartbeat_socket.setsockopt(zmq.IMMEDIATE, 1)
+        heartbeat_socket.setsockopt(zmq.LINGER, 1000)
+        heartbeat_socket.connect(heartbeat_endpoint)
+        _logger.info("Subscribed to %s", endpoint)
+
+        next_heartbeat = time.monotonic()
+        resync_nickname = None
+        while not stop.is_set():
+            if self.nickname != resync_nickname:
+                # Only the resync notices for this client's own nickname are
+                # subscribed to, so that ZMQ filters out the others'
+                if resync_nickname is not None:
+                    socket.setsockopt_string(zmq.UNSUBSCRIBE, self._resync_topic(resync_nickname))
+                resync_nickname = self.nickname
+                if resync_nickname is not None:
+                    socket.setsockopt_string(zmq.SUBSCRIBE, self._resync_topic(resync_nickname))
+            if time.monotonic() >= next_heartbeat:
+                if self._heartbeat(heartbeat_socket, HEARTBEAT):
+                    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+                else:
+                    # Retry soon, e.g. once connected or a nickname is claimed
+                    next_heartbeat = time.monotonic() + POLL_TIMEOUT
+            # Wake up regularly to notice the stop request
+            timeout = min(next_heartbeat - time.monotonic(), POLL_TIMEOUT)
+            if not socket.poll(max(0, int(timeout * 1000))):
+                continue
+            topic, _, message = socket.recv_string().partition(" ")
+            if topic == CHANNEL_TOPIC:
+                sequence, _, message = message.partition(" ")
+                self._track_sequence(int(sequence))
+                on_message(message)
+            elif topic == PRESENCE_TOPIC:
+                event, _, nickname = message.partition(" ")
+                on_presence(event, nickname)
+            elif topic == RESYNC_TOPIC:
+                nickname, _, sequence = message.partition(" ")
+                if nickname == self.nickname:
+                    on_resync(int(sequence))
+                    self._resynced(int(sequence))
+
+        self._heartbeat(heartbeat_socket, LEAVE)
+        heartbeat_socket.close()
+        socket.close(linger=0)
@@ -0,0 +1,210 @@
+"""Server-to-server federation. Every node binds a PUB socket for relaying the
+chat messages and nickname claims to the other nodes and a REP socket for
+syncing its replica with the other nodes. The nodes subscribe to the relay
+sockets of their peers, so each node ends up with a full replica of the chat
+history and of the accounts, and can answer the clients on its own.
+
+Messages are identified by their origin node and sequence number. A node relays
+every message it hasn't seen before to its own peers, which lets the messages
+travel through nodes that aren't directly connected, and drops the duplicates.
+
+The relay drops messages while a link between two nodes is down, so every
+SYNC_INTERVAL each node sends its connected peers a summary of the sequence
+numbers it has from each origin and gets back the messages it is missing,
+along with all of the claims.
+
+The claims carry the hash of the account's cookie rather than the cookie, so
+the federation sockets don't reveal the credentials of the accounts. The
+sockets are bound to the given interface only, the loopback interface unless
+configured otherwise.
+"""
+import json
+import logging
+import threading
+import time
+
+from typing import Sequence
+
+import zmq
+
+import server_func as functions
+
+# The history sync socket is bound to the port right after the relay port
+SYNC_PORT_OFFSET = 1
+POLL_TIMEOUT = 1000  # milliseconds
+SYNC_INTERVAL = 5.0  # seconds
+# Retry interval for the peers that weren't connected at the time of a sync
+SYNC_RETRY_INTERVAL = 0.5  # seconds
+SYNC_REQUEST = b"SYNC"
+# A sync request not answered in this time is considered lost
+SYNC_TIMEOUT = 30.0  # seconds
+CLAIM = "claim"
+MESSAGE = "message"
+
+_logger = logging.getLogger("FEDERATION")
+
+
+class Federation:
+    def __init__(self,
+                 message_queue: functions.MessageQueue,
+                 publisher: functions.Publisher,
+                 port: int,
+                 peers: Sequence[str],
+                 interface: str = functions.FEDERATION_INTERFACE):
+        # Peers are given as "host:port" of their relay socket
+        self.message_queue = message_queue
+        self.publisher = publisher
+        self.port = port
+        self.peers = list(peers)
+        self.interface = interface
+        self._context = zmq.Context.instance()
+        self._relay_lock = threading.Lock()
+        self._relay_socket = self._context.socket(zmq.PUB)
+        self._relay_socket.bind("tcp://{}:{}".format(interface, port))
+        self._thread = None
+
+    def forward(self, message: functions.Message):
+        """Relay a message to the peers. Called for the messages sent to this
+        node as well as the new messages received from the other nodes.
+        """
+        self._relay(self._typed(MESSAGE, message))
+
+    def forward_claim(self, claim: functions.Claim):
+        # Like forward() for the nickname claims
+        self._relay(self._typed(CLAIM, claim))
+
+    def start(self):
+        _logger.info("Federating on %s:%s with peers %s", self.interface, self.port, self.peers)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _decode(payload: bytes):
+        # A malformed payload from a peer mustn't stop the federation thread
+        try:
+            return json.loads(payload)
+        except ValueError:
+            _logger.warning("Received malformed payload from a peer: %s", payload[:100])
+            return None
+
+    def _merge(self, contents: dict):
+        try:
+            if contents.get("type") == CLAIM:
+                claim = functions.Claim.from_dict(contents)
+                if functions.receive_claim(claim):
+                    self.forward_claim(claim)
+                return
+            message = functions.Message.from_dict(contents)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            _logger.warning("Received malformed payload from a peer: %s", contents)
+            return
+        if functions.receive_message(message, self.message_queue, self.publisher):
+            self.forward(message)
+
+    def _relay(self, contents: dict):
+        payload = json.dumps(contents)
+        with self._relay_lock:
+            self._relay_socket.send_string(payload)
+
+    def _run(self):
+        # All of the sockets except the relay socket are only used by this thread
+        subscribe_socket = self._context.socket(zmq.SUB)
+        subscribe_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        sync_socket = self._context.socket(zmq.REP)
+        sync_socket.bind("tcp://{}:{}".format(self.interface, self.port + SYNC_PORT_OFFSET))
+
+        poller = zmq.Poller()
+        poller.register(subscribe_socket, zmq.POLLIN)
+        poller.register(sync_socket, zmq.POLLIN)
+
+        # Sync request socket -> time of the request awaiting a reply
+        sync_requests = {}
+        for peer in self.peers:
+            host, port = peer.rsplit(":", 1)
+            subscribe_socket.connect("tcp://{}:{}".format(host, port))
+            request_socket = self._context.socket(zmq.DEALER)
+            # Requests are only sent to the peers that are up
+            request_socket.setsockopt(zmq.IMMEDIATE, 1)
+            request_socket.setsockopt(zmq.LINGER, 0)
+            request_socket.connect("tcp://{}:{}".format(host, int(port) + SYNC_PORT_OFFSET))
+            poller.register(request_socket, zmq.POLLIN)
+            sync_requests[request_socket] = None
+
+        next_sync = time.monotonic()
+        while True:
+            if time.monotonic() >= next_sync:
+                if self._request_syncs(sync_requests):
+                    next_sync = time.monotonic() + SYNC_INTERVAL
+                else:
+                    next_sync = time.monotonic() + SYNC_RETRY_INTERVAL
+
+            events = dict(poller.poll(POLL_TIMEOUT))
+
+            if subscribe_socket in events:
+                contents = self._decode(subscribe_socket.recv())
+                if contents is not None:
+                    self._merge(contents)
+
+            if sync_socket in events:
+                # Always replied to, as REP can't take the next request before
+                summary = self._summary(self._decode(sync_socket.recv_multipart()[-1]))
+                try:
+                    missing = [self._typed(MESSAGE, message)
+                               for message in self.message_queue.missing_from(summary)]
+                    claims = [self._typed(CLAIM, claim) for claim in functions.get_claims()]
+                    reply = json.dumps(claims + missing)
+                except (TypeError, ValueError) as e:
+                    _logger.warning("Couldn't answer a sync request: %s", e)
+                    reply = json.dumps([])
+                sync_socket.send_string(reply)
+
+            for request_socket in sync_requests:
+                if request_socket in events:
+                    sync_requests[request_socket] = None
+                    history = self._decode(request_socket.recv_multipart()[-1])
+                    if not isinstance(history, list):
+                        continue
+                    if len(history) > 0:
+                        _logger.debug("Received %s messages and claims from a peer", len(history))
+                    for contents in history:
+                        self._merge(contents)
+
+    def _request_syncs(self, sync_requests: dict) -> bool:
+        # Returns whether all of the peers were reached
+        reached = True
+        summary = json.dumps(self.message_queue.summary()).encode("utf-8")
+        now = time.monotonic()
+        for request_socket, requested in sync_requests.items():
+            if requested is not None and now - requested < SYNC_TIMEOUT:
+                # Still waiting for the previous reply
+                continue
+            try:
+                request_socket.send_multipart([b"", SYNC_REQUEST, summary], zmq.NOBLOCK)
+            except zmq.Again:
+                # Not connected (yet), the peer may also be down
+                reached = False
+                continue
+            sync_requests[request_socket] = now
+        return reached
+
+    @staticmethod
+    def _summary(contents) -> dict:
+        # The origin -> [message count, highest sequence number] entries of a
+        # sync request, dropping the malformed ones
+        if not isinstance(contents, dict):
+            _logger.warning("Received malformed sync request from a peer: %s", contents)
+            return {}
+        summary = {}
+        for origin, counts in contents.items():
+            if (isinstance(counts, list) and len(counts) == 2
+                    and all(type(count) is int for count in counts)):
+                summary[origin] = counts
+            else:
+                _logger.warning("Received malformed summary for origin %s: %s", origin, counts)
+        return summary
+
+    @staticmethod
+    def _typed(kind: str, item) -> dict:
+        contents = item.to_dict()
+        contents["type"] = kind
+        return contents
@@ -0,0 +1,135 @@
+"""Presence tracking of the clients that have joined the chat channel. The
+clients send heartbeats to a ZMQ PULL socket next to the publish socket and are
+considered online until PRESENCE_TIMEOUT has passed since their last heartbeat.
+
+The expiry is handled with a timing wheel: each online client sits in the slot
+of the tick its presence expires on, and every tick only the clients in the
+current slot are expired. A heartbeat moves the client into a later slot. This
+keeps both the heartbeats and the expiry O(1) per client regardless of how many
+clients are online.
+"""
+import logging
+import threading
+import time
+
+from typing import Dict, List, Sequence, Set
+
+import zmq
+
+import server_func as functions
+
+# The heartbeat socket is bound to the port right after the publish port
+HEARTBEAT_PORT_OFFSET = 1
+HEARTBEAT = b"HB"
+LEAVE = b"BYE"
+PRESENCE_TIMEOUT = 15.0  # seconds
+TICK_INTERVAL = 1.0  # seconds
+
+_logger = logging.getLogger("PRESENCE")
+
+
+class TimingWheel:
+    def __init__(self, timeout_ticks: int):
+        # One extra slot so that an entry expiring timeout_ticks from now
+        # doesn't land on the slot that is expired next
+        self._slots: List[Set[str]] = [set() for _ in range(timeout_ticks + 1)]
+        self._slot_of: Dict[str, int] = {}
+        self._timeout_ticks = timeout_ticks
+        self._current = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._slot_of
+
+    def keys(self) -> Sequence[str]:
+        return list(self._slot_of.keys())
+
+    def remove(self, key: str) -> bool:
+        slot = self._slot_of.pop(key, None)
+        if slot is None:
+            return False
+        self._slots[slot].discard(key)
+        return True
+
+    def schedule(self, key: str):
+        # (Re)schedule the key to expire after the timeout
+        self.remove(key)
+        slot = (self._current + self._timeout_ticks) % len(self._slots)
+        self._slots[slot].add(key)
+        self._slot_of[key] = slot
+
+    def tick(self) -> Set[str]:
+        # Advance by one tick and return the keys that expired
+        self._current = (self._current + 1) % len(self._slots)
+        expired = self._slots[self._current]
+        self._slots[self._current] = set()
+        for key in expired:
+            del self._slot_of[key]
+        return expired
+
+
+class Presence:
+    def __init__(self, publisher: functions.Publisher, port: int):
+        self.publisher = publisher
+        self.port = port
+        self._lock = threading.Lock()
+        self._wheel = TimingWheel(int(PRESENCE_TIMEOUT / TICK_INTERVAL))
+        self._thread = None
+
+    def online(self) -> Sequence[str]:
+        with self._lock:
+            return sorted(self._wheel.keys())
+
+    def start(self):
+        _logger.info("Receiving heartbeats on port %s", self.port)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self, kind: bytes, cookie: str, delivery: Sequence[int]):
+        try:
+            nickname = functions.get_nickname(cookie)
+        except functions.AccountNotFoundException:
+            # Presence is only tracked for the clients with a nickname
+            return
+        if kind == LEAVE:
+            self.publisher.forget(nickname)
+        elif len(delivery) in [2, 3]:
+            # The last sequence number received, the number of messages missed
+            # by the client and the first of them not yet recovered, if any
+            self.publisher.acknowledge(nickname, *delivery)
+        with self._lock:
+            if kind == LEAVE:
+                changed = self._wheel.remove(nickname)
+            else:
+                changed = nickname not in self._wheel
+                self._wheel.schedule(nickname)
+        if changed:
+            event = "leave" if kind == LEAVE else "join"
+            functions.publish_presence(event, nickname, self.publisher)
+
+    def _run(self):
+        socket = zmq.Context.instance().socket(zmq.PULL)
+        socket.bind("{}:{}".format(functions.ZMQ_BIND_ADDRESS, self.port))
+        next_tick = time.monotonic() + TICK_INTERVAL
+
+        while True:
+            timeout = max(0.0, next_tick - time.monotonic())
+            if socket.poll(int(timeout * 1000)):
+                try:
+                    kind, cookie, *delivery = socket.recv_multipart()
+                    cookie = cookie.decode("ascii")
+                    delivery = [int(frame) for frame in delivery]
+                except ValueError:
+                    _logger.warning("Received malformed heartbeat")
+                    continue
+                self._heartbeat(kind, cookie, delivery)
+
+            while time.monotonic() >= next_tick:
+                next_tick += TICK_INTERVAL
+                with self._lock:
+                    expired = self._wheel.tick()
+                for nickname in expired:
+                    _logger.debug("Presence of %s expired", nickname)
+                    self.publisher.forget(nickname)
+                    functions.publish_presence("leave", nickname, self.publisher)
+                # Keep the subscriber count up to date when nothing is published
+                self.publisher.poll_subscriptions()
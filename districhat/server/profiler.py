@@ -0,0 +1,120 @@
+"""On-demand sampling profiler for the running server. While a profiling session
+is running, the stacks of the threads handling requests are sampled at a fixed
+interval and aggregated per route. Nothing is hooked into the request handling
+when no session is running, so the profiler costs nothing while off.
+
+The result can be output in the collapsed stack format understood by the
+flamegraph tools, one "route;frame;...;frame count" line per distinct stack.
+"""
+import collections
+import itertools
+import logging
+import sys
+import threading
+import time
+
+from typing import Dict
+
+from flask import Flask
+from flask import request_finished
+
+SAMPLE_INTERVAL = 0.005  # seconds
+MAX_DURATION = 300.0  # seconds
+
+_logger = logging.getLogger("PROFILER")
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+class Profile:
+    def __init__(self):
+        # Route -> collapsed stack -> sample count
+        self.routes: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        self.duration = 0.0
+        self.requests = 0
+
+    def collapsed(self) -> str:
+        lines = []
+        for route, stacks in self.routes.items():
+            for stack, count in stacks.items():
+                lines.append((count, "{};{} {}".format(route, stack, count)))
+        lines.sort(reverse=True)
+        return "".join(line + "\n" for _, line in lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "duration": self.duration,
+            "requests": self.requests,
+            "routes": {route: {"samples": sum(stacks.values()),
+                               "stacks": dict(stacks.most_common())}
+                       for route, stacks in self.routes.items()},
+        }
+
+
+class Profiler:
+    def __init__(self, app: Flask):
+        self._app = app
+        self._lock = threading.Lock()
+
+    def profile(self, duration: float, requests: int = None) -> Profile:
+        """Sample the request handling threads for the duration or until the
+        given number of requests has been handled, whichever comes first.
+        The sampling runs in the calling thread. Only one session at a time.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyException("A profiling session is already running")
+        try:
+            return self._profile(min(duration, MAX_DURATION), requests)
+        finally:
+            self._lock.release()
+
+    def _profile(self, duration: float, requests: int = None) -> Profile:
+        # The views are looked up from the frames by their code objects
+        views = {view.__code__: endpoint
+                 for endpoint, view in self._app.view_functions.items()
+                 if hasattr(view, "__code__")}
+        profile = Profile()
+        counter = itertools.count(1)
+        done = threading.Event()
+
+        def on_request_finished(sender, **extra):
+            profile.requests = next(counter)
+            if requests is not None and profile.requests >= requests:
+                done.set()
+
+        # Only connected for the duration of the session
+        request_finished.connect(on_request_finished, self._app)
+        _logger.info("Profiling for %s s or %s requests", duration, requests)
+        start = time.monotonic()
+        try:
+            while time.monotonic() - start < duration and not done.is_set():
+                self._sample(views, profile)
+                time.sleep(SAMPLE_INTERVAL)
+        finally:
+            request_finished.disconnect(on_request_finished, self._app)
+        profile.duration = time.monotonic() - start
+        _logger.info("Profiling finished after %.1f s and %s requests",
+                     profile.duration, profile.requests)
+        return profile
+
+    @staticmethod
+    def _sample(views: dict, profile: Profile):
+        own_thread = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            route = None
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}.{}".format(frame.f_globals.get("__name__", "?"), code.co_name))
+                if code in views:
+                    route = views[code]
+                    break
+                frame = frame.f_back
+            if route is None:
+                # Not handling a request
+                continue
+            profile.routes[route][";".join(reversed(stack))] += 1
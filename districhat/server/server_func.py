@@ -3,101 +3,451 @@ the web requests can be implemented separately. This modular separation allows
 for changing to using different frameworks for the actual server request handler
 implementation whilst keeping the server functionality intact.
 """
+import bisect
+import collections
 import datetime
+import hashlib
+import itertools
 import logging
 import random
 import string
+import threading
+import uuid
 
-from typing import Sequence, Tuple
+from typing import Dict, Optional, Sequence, Tuple
 
 import zmq
 
 # TODO: Placeholder
+# The accounts are keyed by the hash of the cookie, see _account_key(), so that
+# the cookies themselves are never replicated to the other nodes
 ACCOUNTS = {}
+# Reverse index of ACCOUNTS, nickname -> account. Both are only changed holding
+# _accounts_lock.
+NICKNAMES = {}
+# The claim each account's nickname is based on, account -> Claim. Used for
+# resolving conflicting claims made on different federated nodes.
+CLAIMS = {}
+# Reachable ZMQ endpoints of the clients, keyed by account so that the address
+# follows the account over nickname changes
+CLIENT_ADDRESSES = {}
+CHANNEL_TOPIC = "ALL"
 COOKIE_LENGTH = 128
 EPOCH = datetime.datetime(1970, 1, 1)
+PUBLISH_PORT = 31684
+# Number of published chat messages kept for resyncing lagging subscribers
+REPLAY_LENGTH = 1000
+# A subscriber this many messages behind is told to resync
+RESYNC_LAG = 100
+PRESENCE_TOPIC = "PRESENCE"
+# Identifies the messages originating from this server process among the
+# federated nodes. Random so that a restarted node never reuses old ids.
+ORIGIN_ID = uuid.uuid4().hex
 ZMQ_BIND_ADDRESS = "tcp://0.0.0.0"
+# The federation sockets are only reachable locally unless an interface is given
+FEDERATION_INTERFACE = "127.0.0.1"
 
 _logger = logging.getLogger("SERVER-FUNCTIONS")
+_accounts_lock = threading.Lock()
+_sequence = itertools.count()
 
 
 class AccountNotFoundException(Exception):
     pass
 
 
+class ClientAddressNotFoundException(Exception):
+    pass
+
+
+class Claim:
+    """A nickname claim. Claims are replicated between the federated nodes,
+    and when the same nickname has been claimed for different accounts on
+    different nodes, the earliest claim wins on every node.
+    """
+    def __init__(self, account: str, nickname: str, timestamp: float, origin: str = ORIGIN_ID):
+        self.account = account
+        self.nickname = nickname
+        self.timestamp = timestamp
+        self.origin = origin
+
+    @classmethod
+    def from_dict(cls, contents: dict) -> "Claim":
+        return cls(contents["account"],
+                   contents["nickname"],
+                   contents["timestamp"],
+                   contents["origin"])
+
+    def key(self) -> Tuple[float, str]:
+        # Total order of the claims, the same on every node
+        return self.timestamp, self.origin
+
+    def to_dict(self) -> dict:
+        return {
+            "account": self.account,
+            "nickname": self.nickname,
+            "timestamp": self.timestamp,
+            "origin": self.origin,
+        }
+
+
 class Message:
-    def __init__(self, timestamp: float, nickname: str, message_str: str):
+    def __init__(self,
+                 timestamp: float,
+                 nickname: str,
+                 message_str: str,
+                 origin: str = ORIGIN_ID,
+                 sequence: int = None):
         self.timestamp = timestamp
         self.sender = nickname
         self.message = message_str
+        self.origin = origin
+        self.sequence = next(_sequence) if sequence is None else sequence
+
+    @classmethod
+    def from_dict(cls, contents: dict) -> "Message":
+        return cls(contents["timestamp"],
+                   contents["sender"],
+                   contents["message"],
+                   contents["origin"],
+                   contents["sequence"])
 
     def formatted(self) -> str:
         time_str = datetime.datetime.fromtimestamp(self.timestamp).isoformat()
         return " -- ".join([time_str, self.sender, self.message])
 
+    def key(self) -> Tuple[float, str, int]:
+        # Total order of the messages, the same on every node
+        return self.timestamp, self.origin, self.sequence
+
+    def to_dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "sender": self.sender,
+            "message": self.message,
+            "origin": self.origin,
+            "sequence": self.sequence,
+        }
+
 
 class MessageQueue:
+    """The chat history, safe to use from concurrent request handlers.
+
+    Writers take a lock for the short time of inserting a message. Readers
+    don't lock at all: they read the published snapshot, a (messages,
+    formatted messages, head) tuple replaced with a single assignment. The
+    messages below head are never changed, so appending to the end only
+    requires publishing a new head. A message arriving out of order (from
+    another federated node) is inserted into a copy of the lists, leaving the
+    snapshots the readers may be holding intact.
+    """
     def __init__(self):
-        self.messages = []
+        self._lock = threading.Lock()
+        self._keys = []
+        self._seen = set()
+        # origin -> [message count, highest sequence number] for the syncs
+        # between the federated nodes
+        self._origins = {}
+        self._snapshot = ([], [], 0)
 
-    def add_message(self, message: Message):
-        self.messages.append(message)
+    def add_message(self, message: Message) -> bool:
+        # Returns False for a message that has already been stored, e.g. when
+        # it arrives again via another federated node
+        message_id = (message.origin, message.sequence)
+        key = message.key()
+        # Formatting is done once here instead of on every history request
+        formatted = message.formatted()
+        with self._lock:
+            if message_id in self._seen:
+                return False
+            self._seen.add(message_id)
+            origin = self._origins.setdefault(message.origin, [0, -1])
+            origin[0] += 1
+            origin[1] = max(origin[1], message.sequence)
+            messages, formatted_messages, head = self._snapshot
+            # Keep the history in the same order on every node regardless of
+            # the order the messages arrived in
+            index = bisect.bisect(self._keys, key)
+            self._keys.insert(index, key)
+            if index == head:
+                messages.append(message)
+                formatted_messages.append(formatted)
+            else:
+                messages = messages[:index] + [message] + messages[index:head]
+                formatted_messages = formatted_messages[:index] + [formatted] + formatted_messages[index:head]
+            self._snapshot = (messages, formatted_messages, head + 1)
+        return True
+
+    def get_messages(self) -> Sequence[Message]:
+        messages, _, head = self._snapshot
+        return messages[:head]
 
     def get_messages_formatted(self) -> Sequence[str]:
-        formatted_messages = [msg.formatted() for msg in self.messages]
-        return formatted_messages
-
-
-def claim_nickname(nickname: str, cookie: str) -> str:
-    if cookie in ACCOUNTS.keys() and nickname == ACCOUNTS[cookie]:
-        # Nickname exists and the user provided the corresponding cookie
-        _logger.debug("Nickname {} existed for {}.".format(nickname, cookie))
-        _logger.debug("{} == {}".format(nickname, ACCOUNTS[cookie]))
-        response_msg = "Nickname {} is registered to you".format(nickname)
-
-    elif nickname not in ACCOUNTS.values():
-        # Nickname is available
-        if cookie in ACCOUNTS.keys():
-            # User already has a registered nickname
-            old_nickname = ACCOUNTS[cookie]
-            _logger.info("User {} already had the nickname {}. Replacing the nickname with {}.".format(
-                         cookie, old_nickname, nickname))
-            ACCOUNTS.pop(cookie)
-            ACCOUNTS[cookie] = nickname
-            response_msg = "Replaced nickname {} with {}".format(old_nickname, nickname)
+        _, formatted_messages, head = self._snapshot
+        return formatted_messages[:head]
+
+    def missing_from(self, summary: dict) -> Sequence[Message]:
+        """The messages a replica with the given summary doesn't have. The
+        sequence numbers of each origin start from 0 without gaps, so if the
+        replica has as many messages from an origin as its highest sequence
+        number suggests, only the ones after it are missing. Otherwise all of
+        the messages from the origin are sent and the duplicates dropped.
+        """
+        missing = []
+        for message in self.get_messages():
+            count, max_sequence = summary.get(message.origin, (0, -1))
+            if count == max_sequence + 1 and message.sequence <= max_sequence:
+                continue
+            missing.append(message)
+        return missing
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {origin: list(counts) for origin, counts in self._origins.items()}
+
+
+class SubscriberStats:
+    def __init__(self):
+        self.last_sequence = None
+        self.dropped = 0
+        self.resync_from = None
+
+    def to_dict(self, latest_sequence: int) -> dict:
+        lag = None
+        if self.last_sequence is not None:
+            lag = max(0, latest_sequence - self.last_sequence)
+        return {
+            "last_sequence": self.last_sequence,
+            "lag": lag,
+            "dropped": self.dropped,
+        }
+
+
+class Publisher:
+    """The chat channel, published on a ZMQ XPUB socket. The chat messages are
+    numbered so that the subscribers can detect the messages they've missed:
+    a PUB socket drops the messages of a subscriber past the HWM without any
+    signal. The subscribers acknowledge the last sequence number they've
+    received in their heartbeats, which gives their lag and drop counts, and
+    the ones falling behind are told to resync from the first message missed.
+    The XPUB socket tells the number of connected subscribers.
+
+    The socket is shared by the request handlers and the background threads,
+    so all of its use is done holding the lock.
+    """
+    def __init__(self, socket: zmq.Socket):
+        self._socket = socket
+        self._lock = threading.Lock()
+        self._replay = collections.deque(maxlen=REPLAY_LENGTH)
+        self._stats: Dict[str, SubscriberStats] = {}
+        self.sequence = 0
+        self.subscriptions = collections.Counter()
+
+    def acknowledge(self, nickname: str, last_sequence: int, dropped: int, first_missed: int = None):
+        # Heartbeat from a subscriber: the last chat message it received, the
+        # number of messages it noticed missing and the first of them it
+        # hasn't recovered yet
+        with self._lock:
+            stats = self._stats.setdefault(nickname, SubscriberStats())
+            stats.last_sequence = last_sequence
+            stats.dropped = dropped
+            if last_sequence > self.sequence:
+                # Received before this server was restarted, wait for the
+                # subscriber to notice the restart
+                return
+            if first_missed is not None:
+                resync_from = first_missed
+            elif self.sequence - last_sequence >= RESYNC_LAG:
+                resync_from = last_sequence + 1
+            else:
+                return
+            if stats.resync_from == resync_from:
+                # Already notified
+                return
+            stats.resync_from = resync_from
+            self._send("RESYNC {} {}".format(nickname, resync_from))
+        _logger.info("Told %s to resync from %s", nickname, resync_from)
+
+    def forget(self, nickname: str):
+        with self._lock:
+            self._stats.pop(nickname, None)
+
+    def poll_subscriptions(self):
+        with self._lock:
+            self._read_subscriptions()
+
+    def publish(self, topic: str, message_str: str):
+        with self._lock:
+            if topic == CHANNEL_TOPIC:
+                self.sequence += 1
+                message_str = "{} {}".format(self.sequence, message_str)
+                self._replay.append((self.sequence, message_str))
+            self._send("{} {}".format(topic, message_str))
+
+    def replay(self, since: int) -> Optional[Sequence[str]]:
+        # The chat messages published from the sequence number onwards, or None
+        # if they are no longer all kept
+        with self._lock:
+            if len(self._replay) > 0 and self._replay[0][0] > since:
+                return None
+            return [message_str.split(" ", 1)[1]
+                    for sequence, message_str in self._replay if sequence >= since]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._read_subscriptions()
+            return {
+                "sequence": self.sequence,
+                "subscriptions": dict(self.subscriptions),
+                "subscribers": {nickname: stats.to_dict(self.sequence)
+                                for nickname, stats in self._stats.items()},
+            }
+
+    def _read_subscriptions(self):
+        # Subscription events are a single frame: 1 for subscribe and 0 for
+        # unsubscribe followed by the topic. Disconnecting subscribers
+        # unsubscribe implicitly.
+        while True:
+            try:
+                event = self._socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if len(event) == 0:
+                continue
+            topic = event[1:].decode("ascii", "replace")
+            if event[0] == 1:
+                self.subscriptions[topic] += 1
+            else:
+                self.subscriptions[topic] -= 1
+                if self.subscriptions[topic] <= 0:
+                    del self.subscriptions[topic]
+
+    def _send(self, contents: str):
+        self._read_subscriptions()
+        self._socket.send_string(contents)
+
+
+def _account_key(cookie: str) -> str:
+    # The cookie is the only credential of an account, so only its hash is
+    # stored and replicated
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest()
+
+
+def _apply_claim(claim: Claim) -> bool:
+    # Returns whether the accounts changed. Must be called holding _accounts_lock.
+    current = CLAIMS.get(claim.account)
+    if current is not None and current.key() >= claim.key():
+        # The account already has the same or a later nickname
+        return False
+
+    holder = NICKNAMES.get(claim.nickname)
+    if holder is not None and holder != claim.account:
+        if CLAIMS[holder].key() < claim.key():
+            # The nickname was claimed earlier by another account
+            return False
+        # Claimed for another account meanwhile on another node, but later
+        _logger.info("Nickname {} was claimed earlier by {} on another node, removing it from {}.".format(
+                     claim.nickname, claim.account, holder))
+        del ACCOUNTS[holder]
+        del CLAIMS[holder]
+
+    if current is not None and NICKNAMES.get(current.nickname) == claim.account:
+        del NICKNAMES[current.nickname]
+    ACCOUNTS[claim.account] = claim.nickname
+    NICKNAMES[claim.nickname] = claim.account
+    CLAIMS[claim.account] = claim
+    return True
+
+
+def claim_nickname(nickname: str, cookie: str) -> Tuple[str, Optional[Claim]]:
+    # The check and the change are done atomically so that two users can't
+    # claim the same nickname at the same time. Returns the response and the
+    # claim to replicate to the other nodes if the nickname was claimed.
+    claim = None
+    account = _account_key(cookie)
+    with _accounts_lock:
+        if ACCOUNTS.get(account) == nickname:
+            # Nickname exists and the user provided the corresponding cookie
+            _logger.debug("Nickname {} existed for {}.".format(nickname, cookie))
+            response_msg = "Nickname {} is registered to you".format(nickname)
+
+        elif nickname not in NICKNAMES:
+            # Nickname is available
+            old_nickname = ACCOUNTS.get(account)
+            claim = Claim(account, nickname, _get_timestamp())
+            _apply_claim(claim)
+            if old_nickname is not None:
+                # User already had a registered nickname
+                _logger.info("User {} already had the nickname {}. Replacing the nickname with {}.".format(
+                             cookie, old_nickname, nickname))
+                response_msg = "Replaced nickname {} with {}".format(old_nickname, nickname)
+            else:
+                _logger.debug("Nickname {} claimed for {}.".format(nickname, cookie))
+                response_msg = "Claimed nickname {}".format(nickname)
         else:
-            ACCOUNTS[cookie] = nickname
-            _logger.debug("Nickname {} claimed for {}.".format(nickname, cookie))
-            response_msg = "Claimed nickname {}".format(nickname)
-    else:
-        response_msg = "Nickname {} is already in use. Try another one.".format(nickname)
-    return response_msg
+            response_msg = "Nickname {} is already in use. Try another one.".format(nickname)
+    return response_msg, claim
 
 
-def create_publish_socket() -> Tuple[zmq.Socket, int]:
+def create_publisher(port: int = PUBLISH_PORT) -> Tuple[Publisher, int]:
+    # A fixed port lets the subscribers reconnect by themselves after a restart
+    # of the server. Port 0 binds a random port instead.
     context = zmq.Context()
-    socket = context.socket(zmq.PUB)
-    port = socket.bind_to_random_port(ZMQ_BIND_ADDRESS, min_port=49152, max_port=65536, max_tries=100)
-    _logger.info("Created a ZMQ PUB TCP socket on port %s", port)
-    return socket, port
+    socket = context.socket(zmq.XPUB)
+    # Pass on every subscription and unsubscription, not only the first and
+    # the last one for each topic, so that the subscribers can be counted
+    socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+    if port == 0:
+        port = socket.bind_to_random_port(ZMQ_BIND_ADDRESS, min_port=49152, max_port=65536, max_tries=100)
+    else:
+        socket.bind("{}:{}".format(ZMQ_BIND_ADDRESS, port))
+    _logger.info("Created a ZMQ XPUB TCP socket on port %s", port)
+    return Publisher(socket), port
 
 
 def generate_cookie() -> str:
     while True:
         cookie = ''.join([random.choice(string.ascii_letters + string.digits) for i in range(COOKIE_LENGTH)])
-        if cookie not in ACCOUNTS.keys():
+        if _account_key(cookie) not in ACCOUNTS.keys():
             # Make sure there are no duplicates
             return cookie
 
 
-def get_chat_history(message_queue: MessageQueue) -> Sequence[str]:
+def get_chat_history(message_queue: MessageQueue,
+                     publisher: Publisher,
+                     since: int = None) -> Sequence[str]:
+    # With since, only the messages published from that sequence number on,
+    # or everything if those are no longer available
+    if since is not None:
+        messages = publisher.replay(since)
+        if messages is not None:
+            return messages
     return message_queue.get_messages_formatted()
 
 
-def _get_nickname(cookie: str) -> str:
-    if cookie not in ACCOUNTS.keys():
+def get_claims() -> Sequence[Claim]:
+    with _accounts_lock:
+        return list(CLAIMS.values())
+
+
+def get_client_address(nickname: str) -> str:
+    # Only address resolution is done here, the private messages themselves
+    # are sent directly between the clients
+    account = NICKNAMES.get(nickname)
+    if account is None:
+        raise AccountNotFoundException("No account with nickname {}".format(nickname))
+    address = CLIENT_ADDRESSES.get(account)
+    if address is None:
+        raise ClientAddressNotFoundException("No address registered for {}".format(nickname))
+    return address
+
+
+def get_nickname(cookie: str) -> str:
+    # A single lookup as the account may change concurrently
+    nickname = ACCOUNTS.get(_account_key(cookie))
+    if nickname is None:
         raise AccountNotFoundException("No nickname claimed for cookie")
-    return ACCOUNTS[cookie]
+    return nickname
 
 
 def _get_timestamp() -> float:
@@ -105,19 +455,52 @@ def _get_timestamp() -> float:
     return (time_now - EPOCH) / datetime.timedelta(seconds=1)
 
 
-def _publish_message(message: Message, publish_socket: zmq.Socket):
+def _publish_message(message: Message, publisher: Publisher):
     message_str = message.formatted()
     _logger.info("CHAT: {}".format(message_str))
-    publish_socket.send_string("ALL {}".format(message_str))
+    publisher.publish(CHANNEL_TOPIC, message_str)
+
+
+def publish_presence(event: str, nickname: str, publisher: Publisher):
+    # Join & leave events of the clients on a topic of their own
+    _logger.info("PRESENCE: {} {}".format(event, nickname))
+    publisher.publish(PRESENCE_TOPIC, "{} {}".format(event, nickname))
+
+
+def receive_claim(claim: Claim) -> bool:
+    # Apply a nickname claim relayed by another node. Returns whether the
+    # claim changed the accounts on this node.
+    with _accounts_lock:
+        return _apply_claim(claim)
+
+
+def receive_message(message: Message,
+                    message_queue: MessageQueue,
+                    publisher: Publisher) -> bool:
+    # Store & publish a message relayed by another node. Returns whether the
+    # message was new to this node.
+    if not message_queue.add_message(message):
+        return False
+    _publish_message(message, publisher)
+    return True
+
+
+def register_client_address(cookie: str, host: str, port: int) -> str:
+    nickname = get_nickname(cookie)
+    address = "tcp://{}:{}".format(host, port)
+    CLIENT_ADDRESSES[_account_key(cookie)] = address
+    _logger.info("Registered address {} for {}.".format(address, nickname))
+    return address
 
 
 def send_message(cookie: str,
                  message_str: str,
                  message_queue: MessageQueue,
-                 publish_socket: zmq.Socket):
+                 publisher: Publisher) -> Message:
     # Publish & store
     msg_timestamp = _get_timestamp()
-    nickname = _get_nickname(cookie)
+    nickname = get_nickname(cookie)
     message = Message(msg_timestamp, nickname, message_str)
     message_queue.add_message(message)
-    _publish_message(message, publish_socket)
+    _publish_message(message, publisher)
+    return message
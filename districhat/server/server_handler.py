@@ -2,8 +2,13 @@
 of the service by mapping the requests from clients into functions provided by
 server_func.
 """
+import argparse
+import hmac
 import json
 import logging
+import os
+import signal
+import threading
 
 from typing import Optional
 
@@ -11,18 +16,54 @@ from flask import Flask
 from flask import make_response
 from flask import request
 from flask import Response
+from werkzeug.serving import make_server
 
 import server_func as functions
+from federation import Federation
+from presence import HEARTBEAT_PORT_OFFSET, Presence
+from profiler import Profiler, ProfilerBusyException
 
+federation = None
+presence = None
 MESSAGE_QUEUE = functions.MessageQueue()
 publish_port = None
-publish_socket = None
+publisher = None
 SERVER_PORT = 31683
+# The admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get("DISTRICHAT_ADMIN_TOKEN")
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
 
 app = Flask("DistriChat")
+profiler = Profiler(app)
 _logger = logging.getLogger("SERVER")
 
 
+@app.route("/admin/profile", methods=["POST"])
+def admin_profile() -> Response:
+    # Profile the live server for the given number of seconds or requests and
+    # return the hot stacks per route, in collapsed format by default
+    if not _is_admin():
+        return make_response("Forbidden\n", 403)
+
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        requests = request.args.get("requests", None, type=int)
+    except ValueError:
+        return make_response("Erroneous request\n", 400)
+
+    try:
+        profile = profiler.profile(seconds, requests)
+    except ProfilerBusyException:
+        return make_response("Profiling already in progress\n", 409)
+
+    if request.args.get("format", "collapsed") == "json":
+        return make_response(json.dumps(profile.to_dict()))
+    resp = make_response(profile.collapsed())
+    resp.mimetype = "text/plain"
+    return resp
+
+
 @app.route("/claim-nick", methods=["POST"])
 def claim_nick() -> Response:
     # Verify whether the nickname is available
@@ -45,8 +86,10 @@ def claim_nick() -> Response:
     _logger.info("Received nickname claim request for \"{}\" by {}.".format(nickname,
                                                                             cookie))
 
-    response = functions.claim_nickname(nickname, cookie) + "\n"
-    resp = make_response(response)
+    response, claim = functions.claim_nickname(nickname, cookie)
+    if claim is not None and federation is not None:
+        federation.forward_claim(claim)
+    resp = make_response(response + "\n")
     resp.set_cookie("cookie", cookie)
     return resp
 
@@ -62,7 +105,8 @@ def chat_history() -> Response:
     _logger.info("Received chat history get request.")
 
     try:
-        chatlog = functions.get_chat_history(MESSAGE_QUEUE)
+        since = request.args.get("since", None, type=int)
+        chatlog = functions.get_chat_history(MESSAGE_QUEUE, publisher, since)
         _logger.debug(chatlog)
         resp = make_response(json.dumps(chatlog))
         # resp = make_response("Chat history read successfully.\n")
@@ -73,11 +117,26 @@ def chat_history() -> Response:
 
 
 @app.route("/client-address")
-def client_address_for(nickname: str) -> str:
-    # Client requests IP address of another client based on the nickname
-    # Returns IP of client with the requested nickname
+def client_address_for() -> Response:
+    # Client requests the ZMQ endpoint of another client based on the nickname
+    # Returns the endpoint of the client with the requested nickname
     # Meant for establishing P2P between clients
-    return ""
+    error_resp = make_response("Erroneous request\n")
+
+    nickname = request.args.get("nickname", "")
+    if nickname == "":
+        _logger.debug("Request missing nickname!")
+        return error_resp
+
+    _logger.info("Received client address request for \"{}\".".format(nickname))
+
+    try:
+        address = functions.get_client_address(nickname)
+    except functions.AccountNotFoundException:
+        return make_response("No user with nickname {}.\n".format(nickname), 404)
+    except functions.ClientAddressNotFoundException:
+        return make_response("User {} is not reachable directly.\n".format(nickname), 404)
+    return make_response(address)
 
 
 def get_cookie(cookies) -> Optional[str]:
@@ -89,11 +148,50 @@ def get_cookie(cookies) -> Optional[str]:
     return cookie
 
 
+def _is_admin() -> bool:
+    if ADMIN_TOKEN is None:
+        return False
+    token = request.headers.get("X-Admin-Token", "")
+    return hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
 @app.route("/ping")
 def ping():
     return "pongers\n"
 
 
+@app.route("/register-address", methods=["POST"])
+def register_address() -> Response:
+    # Client registers the port of its P2P socket. The host part is taken from
+    # the request so that it is the address the server sees the client at.
+    error_resp = make_response("Erroneous request\n")
+
+    if request.method != "POST":
+        _logger.debug("Request not POST!")
+        return error_resp
+
+    cookie = get_cookie(request.cookies)
+
+    if cookie is None:
+        _logger.debug("Request missing cookie!")
+        return error_resp
+
+    try:
+        port = int(request.form["port"])
+    except (KeyError, ValueError):
+        _logger.debug("Request missing valid port!")
+        return error_resp
+
+    try:
+        address = functions.register_client_address(cookie, request.remote_addr, port)
+    except functions.AccountNotFoundException:
+        return make_response("You need to claim a nickname to register an address!\n")
+
+    resp = make_response("Registered address {}.\n".format(address))
+    resp.set_cookie("cookie", cookie)
+    return resp
+
+
 @app.route("/send-message", methods=["POST"])
 def send_message() -> Response:
     # Validate nickname
@@ -115,7 +213,9 @@ def send_message() -> Response:
     _logger.info("Received request to send a message.")
 
     try:
-        functions.send_message(cookie, message, MESSAGE_QUEUE, publish_socket)
+        sent_message = functions.send_message(cookie, message, MESSAGE_QUEUE, publisher)
+        if federation is not None:
+            federation.forward(sent_message)
         resp = make_response("Message sent successfully.\n")
     except functions.AccountNotFoundException:
         return make_response("You need to claim a nickname to be allowed to send messages!\n")
@@ -129,14 +229,83 @@ def send_message() -> Response:
 
 @app.route("/join")
 def subscribe_channel() -> Response:
-    # TODO: Could keep track of subscribed clients?
-    # Returns the port to connect to
-    resp = make_response(str(port))
+    # Returns the port to connect to. The subscribed clients are tracked by
+    # the heartbeats they send, see presence.py.
+    resp = make_response(str(publish_port))
     return resp
 
 
+@app.route("/stats")
+def stats() -> Response:
+    # Delivery statistics of the publish socket and its subscribers
+    if not _is_admin():
+        return make_response("Forbidden\n", 403)
+    return make_response(json.dumps(publisher.stats()))
+
+
+@app.route("/who")
+def who() -> Response:
+    # Nicknames of the clients currently online, as a JSON list
+    online = presence.online() if presence is not None else []
+    return make_response(json.dumps(online))
+
+
+def _activated_socket_fd() -> Optional[int]:
+    # Listening socket handed over by systemd, see sd_listen_fds(3)
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    if int(os.environ.get("LISTEN_FDS", "0")) < 1:
+        return None
+    return SD_LISTEN_FDS_START
+
+
+def serve(port: int):
+    """Serve the app until SIGTERM. The listening socket is taken from systemd
+    when socket activated so that it stays open over restarts and the clients
+    connecting meanwhile are queued instead of refused. On SIGTERM no new
+    requests are accepted but the ones in flight are finished before exiting.
+    """
+    fd = _activated_socket_fd()
+    if fd is not None:
+        _logger.info("Using the listening socket passed by systemd")
+    server = make_server("0.0.0.0", port, app, threaded=True, fd=fd)
+    # Non-daemon request threads are joined in server_close()
+    server.daemon_threads = False
+
+    def drain(signum, frame):
+        _logger.info("Received signal %s, finishing the requests in flight", signum)
+        # shutdown() blocks until serve_forever() returns so it can't be called
+        # from the thread running it
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, drain)
+    server.serve_forever()
+    server.server_close()
+    _logger.info("Server stopped")
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s:%(levelname)s: %(message)s")
-    publish_socket, port = functions.create_publish_socket()
-    app.run(host="0.0.0.0", port=SERVER_PORT)
+    parser = argparse.ArgumentParser(description="DistriChat server")
+    parser.add_argument("--port", type=int, default=SERVER_PORT,
+                        help="port of the HTTP interface")
+    parser.add_argument("--publish-port", type=int, default=functions.PUBLISH_PORT,
+                        help="port of the ZMQ PUB socket, 0 for a random port")
+    parser.add_argument("--federation-port", type=int, default=None,
+                        help="port for relaying messages to the other server nodes, "
+                             "federation is disabled if not given")
+    parser.add_argument("--federation-interface", default=functions.FEDERATION_INTERFACE,
+                        help="address of the interface to bind the federation ports to")
+    parser.add_argument("--peer", action="append", default=[],
+                        help="host:port of another node's federation port, may be repeated")
+    args = parser.parse_args()
+
+    publisher, publish_port = functions.create_publisher(args.publish_port)
+    presence = Presence(publisher, publish_port + HEARTBEAT_PORT_OFFSET)
+    presence.start()
+    if args.federation_port is not None:
+        federation = Federation(MESSAGE_QUEUE, publisher, args.federation_port, args.peer,
+                                args.federation_interface)
+        federation.start()
+    serve(args.port)
@@ -1,36 +1,121 @@
 """This setup script is used by the server upon startup to setup the serverside.
+
+The systemd unit files are only installed, and the daemon reloaded, when they
+have changed. The server is counted as ready once it answers to /ping, and the
+durations of the setup phases are recorded for following the boot times. The
+revision of a server that became ready is tagged as the last good one, for
+setup_service.py to fall back to if a later revision doesn't come up.
 """
+import contextlib
+import filecmp
+import json
 import logging
 import os
 import subprocess
+import sys
+import time
+
+from typing import Dict
+from urllib import error, request
 
+BOOT_TIMINGS_FILE = "/home/tonibom/districhat_boot.jsonl"
+LAST_GOOD_TAG = "last-good"
+PING_TIMEOUT = 2.0  # seconds
+PING_URL = "http://127.0.0.1:31683/ping"
+READY_POLL_INTERVAL = 0.2  # seconds
+READY_TIMEOUT = 60.0  # seconds
 SERVER_DIR = "/home/tonibom/DistriChat"
-SERVICE_FILE = "/services/districhat.service"
+UNIT_FILES = ["/services/districhat.service", "/services/districhat.socket"]
 SYSTEMD_SERVICE_LOCATION = "/etc/systemd/system/"
 
 _logger = logging.getLogger("SERVER-SETUP")
 
 
+@contextlib.contextmanager
+def _timed(phase: str, timings: Dict[str, float]):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.monotonic() - start, 3)
+        _logger.info("Phase %s took %.3f s", phase, timings[phase])
+
+
+def install_units() -> bool:
+    # Returns whether any of the unit files changed
+    changed = []
+    for unit_file in UNIT_FILES:
+        installed = SYSTEMD_SERVICE_LOCATION + os.path.basename(unit_file)
+        if os.path.exists(installed) and filecmp.cmp(SERVER_DIR + unit_file, installed, shallow=False):
+            continue
+        changed.append(SERVER_DIR + unit_file)
+
+    if len(changed) == 0:
+        _logger.info("Service files are up to date.")
+        return False
+
+    # Copied rather than moved to keep the checkout clean for fast-forwarding
+    call = ["sudo", "cp"] + changed + [SYSTEMD_SERVICE_LOCATION]
+    subprocess.run(call, check=True)
+    _logger.info("Added the service files {} to services.".format(changed))
+    return True
+
+
+def wait_until_ready() -> bool:
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            reply_msg = request.urlopen(PING_URL, timeout=PING_TIMEOUT).read().decode("ascii")
+            if reply_msg == "pongers\n":
+                return True
+        except (error.URLError, OSError):
+            pass
+        time.sleep(READY_POLL_INTERVAL)
+    return False
+
+
 def main():
 
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s:%(levelname)s: %(message)s")
     _logger.info("Starting up...")
     os.chdir(SERVER_DIR)
+    # Set by setup_service.py when the code has changed
+    restart = "--restart" in sys.argv[1:]
+    timings = {}
 
-    call = ["sudo", "mv", SERVER_DIR + SERVICE_FILE, SYSTEMD_SERVICE_LOCATION]
-    subprocess.run(call, check=True)
-    _logger.info("Added the service file to services.")
+    with _timed("units", timings):
+        if install_units():
+            call = ["sudo", "systemctl", "daemon-reload"]
+            subprocess.run(call, check=True)
+            _logger.info("Reloaded systemctl daemon.")
+            restart = True
 
-    call = ["sudo", "systemctl", "daemon-reload"]
-    subprocess.run(call, check=True)
-    _logger.info("Reloaded systemctl daemon.")
+    with _timed("start", timings):
+        call = ["sudo", "systemctl", "start", "districhat.socket"]
+        subprocess.run(call, check=True)
+        _logger.info("Started up districhat.socket")
 
-    call = ["sudo", "systemctl", "start", "districhat.service"]
-    subprocess.run(call, check=True)
-    _logger.info("Started up districhat.service")
+        action = "restart" if restart else "start"
+        call = ["sudo", "systemctl", action, "districhat.service"]
+        subprocess.run(call, check=True)
+        _logger.info("Ran {} for districhat.service".format(action))
+
+    with _timed("ready", timings):
+        ready = wait_until_ready()
 
-    _logger.info("Finished server setup")
+    with open(BOOT_TIMINGS_FILE, "a") as timings_file:
+        timings_file.write(json.dumps({"script": "server_setup",
+                                       "time": time.time(),
+                                       "ready": ready,
+                                       "phases": timings}) + "\n")
+
+    if not ready:
+        _logger.error("Server didn't answer to ping in {} seconds".format(READY_TIMEOUT))
+        sys.exit(1)
+    call = ["git", "tag", "--force", LAST_GOOD_TAG, "HEAD"]
+    subprocess.run(call, check=True)
+    _logger.info("Finished server setup, server is ready")
 
 
 if __name__ == "__main__":
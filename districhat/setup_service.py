@@ -1,41 +1,152 @@
 """This python script is run on the serverside when the server boots up.
-This script clones the GitHub repository and runs the server_setup.py script
-from within the repository.
+This script updates the local checkout of the GitHub repository and runs the
+server_setup.py script from within the repository.
+
+The checkout is only fast-forwarded instead of cloned anew. A bare mirror of
+the repository is kept next to it, so the checkout can be created or updated
+from the mirror when GitHub can't be reached, and if neither works the server
+is started from the tree of the previous boot. If the server doesn't come up
+with a new revision, the checkout is reset to the last revision the server was
+ready with, as tagged by server_setup.py, and the server is started from that.
 """
+import contextlib
+import json
 import logging
 import os
 import subprocess
+import time
 
+from typing import Dict, Optional
 
+BOOT_TIMINGS_FILE = "/home/tonibom/districhat_boot.jsonl"
+BRANCH = "master"
+GIT_TIMEOUT = 30  # seconds
+LAST_GOOD_TAG = "last-good"
 REPOSITORY = "git@github.com:tonibom/DistriChat.git"
 REPOSITORY_NAME = "DistriChat"
+MIRROR_NAME = "DistriChat.git"
 SERVER_PATH = "/home/tonibom"
 SRC_LOCATION = "/districhat"
 
 _logger = logging.getLogger("DC-INSTALLER")
 
 
+@contextlib.contextmanager
+def _timed(phase: str, timings: Dict[str, float]):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.monotonic() - start, 3)
+        _logger.info("Phase %s took %.3f s", phase, timings[phase])
+
+
+def _git(*args: str, cwd: str = None) -> bool:
+    call = ["git"] + list(args)
+    try:
+        subprocess.run(call, cwd=cwd or SERVER_PATH, check=True, timeout=GIT_TIMEOUT)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        _logger.warning("%s failed: %s", " ".join(call), e)
+        return False
+    return True
+
+
+def _revision(repository: str, ref: str = "HEAD") -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--verify", "--quiet", ref + "^{commit}"],
+                                cwd=repository, check=True, capture_output=True, text=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    return result.stdout.strip()
+
+
+def update_mirror(mirror: str) -> bool:
+    # Bring the local mirror up to date with GitHub
+    if os.path.exists(mirror):
+        _logger.debug("Updating mirror of {}...".format(REPOSITORY))
+        return _git("remote", "update", "--prune", cwd=mirror)
+    _logger.debug("Creating mirror of {}...".format(REPOSITORY))
+    return _git("clone", "--mirror", REPOSITORY, mirror)
+
+
+def update_checkout(checkout: str, mirror: str, mirror_updated: bool) -> bool:
+    """Fast-forward the checkout from the mirror. GitHub is only tried as a
+    fallback when the mirror was updated, as a failed update means that
+    GitHub is most likely unreachable and waiting for it again would only
+    slow down the boot. Returns whether the checkout exists, which it does even
+    if the update failed but there was a checkout from before.
+    """
+    if mirror_updated:
+        sources = [mirror, REPOSITORY]
+    else:
+        sources = [mirror] if os.path.exists(mirror) else []
+
+    if not os.path.exists(checkout):
+        # Without a previous tree GitHub is still worth a try
+        for source in sources or [REPOSITORY]:
+            _logger.debug("Cloning repository from {}...".format(source))
+            if _git("clone", "--branch", BRANCH, source, REPOSITORY_NAME):
+                return True
+        return False
+
+    # Restore the tracked files first, e.g. the unit files earlier boots moved
+    # out of the checkout, as local changes would stop the fast-forward
+    _git("reset", "--hard", cwd=checkout)
+    for source in sources:
+        _logger.debug("Fetching repository from {}...".format(source))
+        if _git("fetch", source, BRANCH, cwd=checkout):
+            if _git("merge", "--ff-only", "FETCH_HEAD", cwd=checkout):
+                return True
+            # Diverged from upstream, don't try to resolve it at boot
+            break
+    _logger.warning("Couldn't update the repository, using the previous tree.")
+    return True
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
+    timings = {}
+
+    checkout = SERVER_PATH + "/" + REPOSITORY_NAME
+    mirror = SERVER_PATH + "/" + MIRROR_NAME
+    old_revision = _revision(checkout)
 
-    os.chdir(SERVER_PATH)
-    if os.path.exists(SERVER_PATH + "/" + REPOSITORY_NAME):
-        _logger.info("Repository exists already. Removing old one.")
-        call = ["rm", "-rf", REPOSITORY_NAME]
-        subprocess.run(call, check=True)
-        _logger.info("Old repository removed.")
+    with _timed("mirror", timings):
+        mirror_updated = update_mirror(mirror)
 
-    _logger.debug("Cloning repository {}...".format(REPOSITORY))
-    call = ["git", "clone", REPOSITORY]
-    subprocess.run(call, check=True)
-    _logger.debug("Successfully cloned repository.")
+    with _timed("checkout", timings):
+        if not update_checkout(checkout, mirror, mirror_updated):
+            raise RuntimeError("No source for the repository available")
 
-    os.chdir(SERVER_PATH + REPOSITORY_NAME + SRC_LOCATION)
+    new_revision = _revision(checkout)
+    _logger.info("Repository at {} (was {}).".format(new_revision, old_revision))
 
     _logger.debug("Running server_setup.py")
     call = ["python3", "server_setup.py"]
-    subprocess.run(call, check=True)
-    _logger.debug("Started server_setup.py")
+    if new_revision != old_revision:
+        # New code, a running server needs to be restarted to use it
+        call.append("--restart")
+    with _timed("server_setup", timings):
+        result = subprocess.run(call, cwd=checkout + SRC_LOCATION)
+
+    last_good = _revision(checkout, LAST_GOOD_TAG)
+    if result.returncode != 0 and last_good not in [None, new_revision]:
+        _logger.warning("Server setup failed at {}, falling back to {}.".format(new_revision, last_good))
+        with _timed("rollback", timings):
+            if not _git("reset", "--hard", LAST_GOOD_TAG, cwd=checkout):
+                raise RuntimeError("Couldn't fall back to the last good revision")
+            new_revision = last_good
+            call = ["python3", "server_setup.py", "--restart"]
+            result = subprocess.run(call, cwd=checkout + SRC_LOCATION)
+    _logger.debug("Finished server_setup.py")
+
+    with open(BOOT_TIMINGS_FILE, "a") as timings_file:
+        timings_file.write(json.dumps({"script": "setup_service",
+                                       "time": time.time(),
+                                       "revision": new_revision,
+                                       "phases": timings}) + "\n")
+    if result.returncode != 0:
+        raise RuntimeError("Server setup failed at {}".format(new_revision))
 
 
 if __name__ == "__main__":
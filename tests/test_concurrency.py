@@ -0,0 +1,153 @@
+"""Stress checks for the server state shared by the concurrent request
+handlers: the accounts and the chat history. Run with unittest or pytest, or as
+a script to also print the read throughput of the chat history at several
+thread counts.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "districhat", "server"))
+
+import server_func as functions  # noqa: E402
+
+THREADS = 8
+CLAIMS_PER_THREAD = 200
+MESSAGES = 2000
+READ_DURATION = 1.0  # seconds
+# The readers share the GIL, so the reads can't scale past a single core, but
+# concurrent readers mustn't slow each other down either, e.g. on a lock
+READ_SCALING_MIN = 0.5
+
+
+def _run_threads(target, count: int = THREADS):
+    start = threading.Barrier(count)
+
+    def run(index: int):
+        start.wait()
+        target(index)
+
+    threads = [threading.Thread(target=run, args=(index, )) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _history(messages: int = MESSAGES) -> functions.MessageQueue:
+    message_queue = functions.MessageQueue()
+    for sequence in range(messages):
+        message_queue.add_message(functions.Message(float(sequence), "nick", "message", "origin", sequence))
+    return message_queue
+
+
+def read_throughput(message_queue: functions.MessageQueue,
+                    threads: int = THREADS,
+                    duration: float = READ_DURATION) -> float:
+    # Chat history reads per second over all of the threads
+    reads = [0] * threads
+    deadline = time.monotonic() + duration
+
+    def read(index: int):
+        while time.monotonic() < deadline:
+            message_queue.get_messages_formatted()
+            reads[index] += 1
+
+    _run_threads(read, threads)
+    return sum(reads) / duration
+
+
+class ConcurrentClaimsTest(unittest.TestCase):
+    def setUp(self):
+        functions.ACCOUNTS.clear()
+        functions.NICKNAMES.clear()
+        functions.CLAIMS.clear()
+
+    def test_nickname_claimed_once(self):
+        # Every thread claims the same nicknames, each with its own cookies
+        claimed = [[] for _ in range(THREADS)]
+
+        def claim(index: int):
+            for number in range(CLAIMS_PER_THREAD):
+                cookie = "cookie-{}-{}".format(index, number)
+                _, claim = functions.claim_nickname("nick-{}".format(number), cookie)
+                if claim is not None:
+                    claimed[index].append(claim)
+
+        _run_threads(claim)
+        claims = [claim for claims in claimed for claim in claims]
+        self.assertEqual(len(claims), CLAIMS_PER_THREAD)
+        self.assertEqual(len(functions.ACCOUNTS), CLAIMS_PER_THREAD)
+        for claim in claims:
+            self.assertEqual(functions.NICKNAMES[claim.nickname], claim.account)
+            self.assertEqual(functions.ACCOUNTS[claim.account], claim.nickname)
+
+    def test_renames_keep_index_consistent(self):
+        # Every thread keeps renaming its own account over a shared set of
+        # nicknames
+        def rename(index: int):
+            cookie = "cookie-{}".format(index)
+            for number in range(CLAIMS_PER_THREAD):
+                functions.claim_nickname("nick-{}".format(number % THREADS), cookie)
+
+        _run_threads(rename)
+        self.assertEqual(len(functions.NICKNAMES), len(functions.ACCOUNTS))
+        for account, nickname in functions.ACCOUNTS.items():
+            self.assertEqual(functions.NICKNAMES[nickname], account)
+
+
+class ConcurrentHistoryTest(unittest.TestCase):
+    def test_snapshots_ordered_during_out_of_order_inserts(self):
+        message_queue = functions.MessageQueue()
+        done = threading.Event()
+        errors = []
+
+        def insert(index: int):
+            # Interleaved timestamps, so most of the messages are inserted
+            # before the end of the history
+            for number in range(index, MESSAGES, THREADS):
+                timestamp = float(MESSAGES - number if number % 2 else number)
+                message = functions.Message(timestamp, "nick", "message", "origin-{}".format(index), number)
+                message_queue.add_message(message)
+
+        def read():
+            while not done.is_set():
+                keys = [message.key() for message in message_queue.get_messages()]
+                if keys != sorted(keys):
+                    errors.append(keys)
+                    return
+                if len(message_queue.get_messages_formatted()) < len(keys):
+                    errors.append(keys)
+                    return
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        _run_threads(insert)
+        done.set()
+        for reader in readers:
+            reader.join()
+
+        self.assertEqual(errors, [])
+        messages = message_queue.get_messages()
+        self.assertEqual(len(messages), MESSAGES)
+        self.assertEqual([message.key() for message in messages],
+                         sorted(message.key() for message in messages))
+
+    def test_read_throughput_with_concurrent_readers(self):
+        message_queue = _history()
+        single = read_throughput(message_queue, 1, 0.3)
+        concurrent = read_throughput(message_queue, THREADS, 0.3)
+        self.assertGreaterEqual(concurrent, single * READ_SCALING_MIN,
+                                "{:.0f} reads/s with {} threads, {:.0f} with 1".format(
+                                    concurrent, THREADS, single))
+
+
+if __name__ == "__main__":
+    queue = _history()
+    for thread_count in [1, 2, 4, 8]:
+        print("{:.0f} chat history reads/s with {} threads and {} messages".format(
+              read_throughput(queue, thread_count), thread_count, MESSAGES))
+    unittest.main()